@@ -1,18 +1,37 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, Response, g, request, jsonify, send_file
 from PyPDF2 import PdfReader, PdfWriter
-from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import letter
+from PyPDF2.generic import ArrayObject, ByteStringObject, DecodedStreamObject, DictionaryObject, IndirectObject, NameObject, NumberObject, StreamObject
 import logging
 import io
 import json
 from datetime import datetime
 from google.cloud import storage
 import os
-from flasgger import Swagger
 import zipfile
+import base64
+import bisect
+import hashlib
+import itertools
+import re
+import threading
+import time
+import mmap
+import multiprocessing
+import atexit
+import queue
+import random
+import unicodedata
+import uuid
+import zlib
+from urllib.parse import quote
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
 
+from google.api_core import exceptions as gcs_exceptions
+from google.auth import exceptions as google_auth_exceptions
+from google.auth import jwt
 from google.auth.transport import requests
-from google.oauth2 import id_token
 
 
 app = Flask(__name__)
@@ -31,40 +50,685 @@ app.config['SWAGGER'] = {
         }
     }
 }
-swagger = Swagger(app)
+
+
+class LazyDocsMiddleware:
+    """
+    WSGI middleware that serves the Swagger UI and spec from a separate docs
+    app, built on the first request for one of DOCS_PATH_PREFIXES. Importing
+    flasgger is a large share of the module's import time and production
+    traffic never asks for the docs, so cold starts no longer pay for it. The
+    docs app mirrors this app's routes, so flasgger documents the same view
+    functions; it only ever receives documentation requests.
+    """
+
+    DOCS_PATH_PREFIXES = ('/apidocs', '/apispec_', '/flasgger_static')
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+        self._docs_app = None
+        self._lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        if environ.get('PATH_INFO', '').startswith(self.DOCS_PATH_PREFIXES):
+            return self._get_docs_app()(environ, start_response)
+        return self.wsgi_app(environ, start_response)
+
+    def _get_docs_app(self):
+        with self._lock:
+            if self._docs_app is None:
+                from flasgger import Swagger
+
+                docs_app = Flask(__name__)
+                docs_app.config['SWAGGER'] = app.config['SWAGGER']
+                for rule in app.url_map.iter_rules():
+                    if rule.endpoint != 'static':
+                        docs_app.add_url_rule(rule.rule, rule.endpoint, app.view_functions[rule.endpoint], methods=rule.methods)
+                Swagger(docs_app)
+                self._docs_app = docs_app
+            return self._docs_app
+
+
+app.wsgi_app = LazyDocsMiddleware(app.wsgi_app)
 
 
 BUCKET_NAME = os.environ.get('GCS_BUCKET_NAME')
+GOOGLE_CERTS_URL = 'https://www.googleapis.com/oauth2/v1/certs'
+GOOGLE_ISSUERS = ('accounts.google.com', 'https://accounts.google.com')
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 1024))
+CONTRACT_LATEST_PREFIX = 'contract_latest/'
+CONTRACT_LATEST_RETRIES = 10
+CONTRACT_LATEST_BACKOFF = 0.05
+CONTRACT_LATEST_MAX_BACKOFF = 2
+CONTRACT_LATEST_LOCK_STRIPES = 64
+CONTRACT_UPLOAD_ATTEMPTS = 5
+ZIP_DOWNLOAD_CONCURRENCY = int(os.environ.get('ZIP_DOWNLOAD_CONCURRENCY', 8))
+ZIP_MAX_INFLIGHT_BYTES = int(os.environ.get('ZIP_MAX_INFLIGHT_BYTES', 64 * 1024 * 1024))
+BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS', 1000))
+BATCH_UPLOAD_CONCURRENCY = int(os.environ.get('BATCH_UPLOAD_CONCURRENCY', 8))
+RENDER_BACKEND = os.environ.get('RENDER_BACKEND', 'thread')
+RENDER_PROCESSES = int(os.environ.get('RENDER_PROCESSES', os.cpu_count() or 1))
+UPLOAD_MODE = os.environ.get('UPLOAD_MODE', 'sync')
+UPLOAD_SPOOL_DIR = os.environ.get('UPLOAD_SPOOL_DIR', '/tmp/contract_spool')
+UPLOAD_SPOOL_SHUTDOWN_TIMEOUT = float(os.environ.get('UPLOAD_SPOOL_SHUTDOWN_TIMEOUT', 30))
+OUTPUT_MODE = os.environ.get('OUTPUT_MODE', 'rewrite')
+TEMPLATE_LOADING = os.environ.get('TEMPLATE_LOADING', 'eager')
+STARTUP_DOWNLOAD_CONCURRENCY = int(os.environ.get('STARTUP_DOWNLOAD_CONCURRENCY', 8))
+PREWARM_TEMPLATES = [name.strip() for name in os.environ.get('PREWARM_TEMPLATES', '').split(',') if name.strip()]
+LOCAL_CACHE_DIR = os.environ.get('LOCAL_CACHE_DIR')
+TEMPLATE_MMAP_DIR = os.environ.get('TEMPLATE_MMAP_DIR')
+TEMPLATE_REFRESH_INTERVAL = float(os.environ.get('TEMPLATE_REFRESH_INTERVAL', 0))
+TEMPLATE_BUNDLE_CACHE_SIZE = int(os.environ.get('TEMPLATE_BUNDLE_CACHE_SIZE', 16))
+RENDER_CACHE_MAX_BYTES = int(os.environ.get('RENDER_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+IDEMPOTENCY_STORE = os.environ.get('IDEMPOTENCY_STORE', 'memory')
+IDEMPOTENCY_MAX_KEYS = int(os.environ.get('IDEMPOTENCY_MAX_KEYS', 10000))
+IDEMPOTENCY_KEY_TTL = int(os.environ.get('IDEMPOTENCY_KEY_TTL', 24 * 60 * 60))
+IDEMPOTENCY_PREFIX = 'idempotency/'
+PRELOAD_APP = os.environ.get('PRELOAD_APP', 'false').lower() == 'true'
+
+# Render worker processes (RENDER_BACKEND='process') are spawned and import
+# this module too. They are started as RenderWorkerProcess, which multiprocessing
+# names RENDER_WORKER_NAME in the child before that import happens, and get
+# their templates from the pool initializer, so the GCS startup load and the
+# background threads are skipped in them.
+RENDER_WORKER_NAME = 'pdf-render-worker'
+IS_RENDER_WORKER = multiprocessing.current_process().name == RENDER_WORKER_NAME
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 storage_client = None
 bucket = None
-COORDINATES = {}
-PDF_TEMPLATE_CACHE = {}
+
+StaticField = namedtuple('StaticField', ['name', 'page', 'x', 'y', 'align'])
+ItemsSection = namedtuple('ItemsSection', ['page', 'start_y', 'line_height', 'columns'])
+RenderPlan = namedtuple('RenderPlan', ['static_fields', 'items_section'])
+BaseDocument = namedtuple('BaseDocument', ['data', 'reader', 'page_ranges'])
+
+ITEM_COLUMNS = (('name', 'name_x'), ('qty', 'qty_x'), ('price', 'price_x'), ('total', 'total_x'))
+
+
+class TemplateStream(io.RawIOBase):
+    """
+    Read-only, seekable stream over immutable template bytes (or a read-only
+    memory map of them).
+    Every instance keeps its own position over a shared memoryview, so any
+    number of threads can read the same template at once without locking
+    and without copying the underlying bytes.
+    """
+
+    def __init__(self, data):
+        self._view = memoryview(data)
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = len(self._view) + offset
+        else:
+            raise ValueError(f"Invalid whence: {whence}")
+        if pos < 0:
+            raise ValueError(f"Negative seek position: {pos}")
+        self._pos = pos
+        return self._pos
+
+    def readinto(self, buffer):
+        start = min(self._pos, len(self._view))
+        end = min(start + len(buffer), len(self._view))
+        size = end - start
+        buffer[:size] = self._view[start:end]
+        self._pos = end
+        return size
+
+
+def map_pdf_bytes(data):
+    """
+    Writes PDF bytes once to a content-addressed file under TEMPLATE_MMAP_DIR
+    and returns a read-only memory map of it. Every process on the instance
+    that maps the same content maps the same file, so they share one copy in
+    the page cache instead of each keeping the bytes on its own heap.
+    """
+    path = os.path.join(TEMPLATE_MMAP_DIR, f"{hashlib.sha256(data).hexdigest()}.pdf")
+    if not (os.path.isfile(path) and os.path.getsize(path) == len(data)):
+        os.makedirs(TEMPLATE_MMAP_DIR, exist_ok=True)
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+    with open(path, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _share_stream_data(reader, data):
+    """
+    Points the raw data of every parsed stream object back at the region of
+    `data` it was read from, as a zero-copy slice, so the reader keeps only
+    the object dictionaries on the heap. Streams never live in object streams,
+    so each one has its own xref offset; a stream whose bytes cannot be found
+    there unchanged keeps its private copy.
+    """
+    view = memoryview(data)
+    for generation, objects in reader.xref.items():
+        for idnum, offset in objects.items():
+            obj = reader.resolved_objects.get((generation, idnum))
+            if not isinstance(obj, StreamObject) or not isinstance(obj._data, bytes):
+                continue
+            keyword = data.find(b'stream', offset)
+            if keyword < 0:
+                continue
+            start = keyword + len(b'stream')
+            start += 2 if data[start:start + 2] == b'\r\n' else 1
+            length = len(obj._data)
+            if view[start:start + length] == obj._data:
+                obj._data = view[start:start + length]
+
+
+class TemplateReader(PdfReader):
+    """
+    PdfReader over a template that is shared by every request. PyPDF2 reads
+    `pdf_header` from the stream on every `add_page` (tell/seek/read/seek on
+    the reader's one stream), so it is read once while parsing and served from
+    memory afterwards; nothing touches the shared stream position again.
+    """
+
+    def __init__(self, stream):
+        super().__init__(stream)
+        self._pdf_header = super().pdf_header
+
+    @property
+    def pdf_header(self):
+        return self._pdf_header
+
+
+def parse_pdf_bytes(data):
+    """
+    Parses immutable PDF bytes once and resolves the whole object graph up
+    front. Requests only clone pages out of the returned reader, so it never
+    has to touch its stream again and can be shared by every request. Stream
+    data stays in `data` (see _share_stream_data) instead of being copied.
+    """
+    reader = TemplateReader(TemplateStream(data))
+    len(reader.pages)
+    for generation, objects in reader.xref.items():
+        for idnum in objects:
+            reader.get_object(IndirectObject(idnum, generation, reader))
+    for idnum in reader.xref_objStm:
+        reader.get_object(IndirectObject(idnum, 0, reader))
+    _share_stream_data(reader, data)
+    return reader
+
+
+def _coordinate(config, key, where):
+    value = config.get(key)
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError(f"{where}: '{key}' must be a number, got {value!r}.")
+    return value
+
+
+def _page_index(config, where):
+    page = config.get('page', 1)
+    if isinstance(page, bool) or not isinstance(page, int) or page < 1:
+        raise ValueError(f"{where}: 'page' must be a positive integer, got {page!r}.")
+    return page - 1
+
+
+def compile_render_plan(template_name, template_coords):
+    """
+    Compiles the coordinates.json entry of a template into an immutable
+    RenderPlan with page indexes, alignment and column offsets resolved.
+    Raises ValueError describing the first invalid entry.
+    """
+    static_fields = []
+    for field_name, coords in template_coords.get('static_fields', {}).items():
+        where = f"{template_name}.static_fields.{field_name}"
+        align = coords.get('align', 'left')
+        if align not in ('left', 'center'):
+            raise ValueError(f"{where}: 'align' must be 'left' or 'center', got {align!r}.")
+        static_fields.append(StaticField(field_name, _page_index(coords, where),
+                                         _coordinate(coords, 'x', where), _coordinate(coords, 'y', where), align))
+
+    items_section = None
+    items_config = template_coords.get('items_section')
+    if items_config:
+        where = f"{template_name}.items_section"
+        columns = items_config.get('columns', {})
+        items_section = ItemsSection(
+            _page_index(items_config, where),
+            _coordinate(items_config, 'start_y', where),
+            _coordinate(items_config, 'line_height', where),
+            tuple((key, _coordinate(columns, column, f"{where}.columns")) for key, column in ITEM_COLUMNS))
+
+    return RenderPlan(tuple(static_fields), items_section)
+
+
+def compile_render_plans(coordinates):
+    """Compiles every template in coordinates.json, logging and skipping the invalid ones."""
+    plans = {}
+    for template_name, template_coords in coordinates.items():
+        try:
+            plans[template_name] = compile_render_plan(template_name, template_coords)
+        except (ValueError, AttributeError) as e:
+            logging.error(f"Invalid coordinates for template '{template_name}', it cannot be rendered: {e}")
+    return plans
+
+
+def bind_render_plan(plan, context):
+    """
+    Binds context values into a compiled plan. Returns the strings to draw,
+    grouped by page index, as `(x, y, text, align)` tuples.
+    """
+    draws_by_page = {}
+    for field in plan.static_fields:
+        if field.name in context:
+            draws_by_page.setdefault(field.page, []).append((field.x, field.y, str(context[field.name]), field.align))
+
+    section = plan.items_section
+    if section and context.get('items'):
+        draws = draws_by_page.setdefault(section.page, [])
+        current_y, last_item_y = section.start_y, 0
+        for item in context['items']:
+            for key, x in section.columns:
+                draws.append((x, current_y, str(item.get(key, '')), 'left'))
+            last_item_y = current_y
+            current_y -= section.line_height
+        if context.get('total') and last_item_y > 0:
+            total_x = section.columns[0][1]
+            draws.append((total_x, last_item_y - (2 * section.line_height), f"Total: {context['total']}", 'left'))
+
+    return draws_by_page
+
+
+class TemplateSnapshot:
+    """
+    One consistent generation of coordinates.json, its compiled render plans
+    and the template PDFs (raw bytes, parsed reader, content digest and GCS
+    generation per template), plus the bundles pre-merged from them for the
+    incremental output mode.
+
+    Published snapshots are never changed in place, apart from templates that
+    are loaded on demand being added. The refresher publishes changes as a new
+    snapshot by rebinding `template_snapshot`; a request picks the snapshot up
+    once and uses it throughout, so it finishes on the one it started with.
+    """
+
+    def __init__(self, coordinates=None, coordinates_generation=None):
+        self.coordinates = coordinates or {}
+        self.coordinates_generation = coordinates_generation
+        self.render_plans = compile_render_plans(self.coordinates)
+        self.pdf_bytes = {}
+        self.digests = {}
+        self.generations = {}
+        self.parsed = {}
+        self.bundles = OrderedDict()
+        self.bundles_lock = threading.Lock()
+        self._loads = {}
+        self._loads_lock = threading.Lock()
+
+    def add_template(self, template_name, data, reader, generation):
+        """Adds a downloaded and parsed template; it is usable once its reader is in `parsed`."""
+        self.pdf_bytes[template_name] = data
+        self.digests[template_name] = hashlib.sha256(data).hexdigest()
+        self.generations[template_name] = generation
+        self.parsed[template_name] = reader
+
+    def copy_template(self, other, template_name):
+        """Reuses an unchanged template of an older snapshot."""
+        self.pdf_bytes[template_name] = other.pdf_bytes[template_name]
+        self.digests[template_name] = other.digests[template_name]
+        self.generations[template_name] = other.generations[template_name]
+        self.parsed[template_name] = other.parsed[template_name]
+
+    def ensure_template(self, template_name):
+        """
+        Loads `templates/{template_name}.pdf` from GCS on first use and returns
+        whether the template is available. Concurrent first requests for the
+        same template share one download; a missing PDF is not remembered, so
+        it can be uploaded later without a restart.
+        """
+        if template_name in self.parsed:
+            return True
+        with self._loads_lock:
+            if template_name in self.parsed:
+                return True
+            future = self._loads.get(template_name)
+            owner = future is None
+            if owner:
+                future = self._loads[template_name] = Future()
+
+        if owner:
+            try:
+                blob_name = f"templates/{template_name}.pdf"
+                if local_cache is not None:
+                    # The local cache needs the object's metadata to validate its copy.
+                    blob = bucket.get_blob(blob_name)
+                    if blob is None:
+                        raise gcs_exceptions.NotFound(blob_name)
+                else:
+                    blob = bucket.blob(blob_name)
+                data, reader, download_ms, parse_ms = load_template_blob(blob)
+                self.add_template(template_name, data, reader, blob.generation)
+                app.logger.info(f"Loaded template on demand from GCS: '{blob.name}' (download {download_ms:.1f} ms, parse {parse_ms:.1f} ms)")
+                future.set_result(True)
+            except gcs_exceptions.NotFound:
+                future.set_result(False)
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                with self._loads_lock:
+                    del self._loads[template_name]
+        return future.result()
+
+
+template_snapshot = TemplateSnapshot()
+
+
+class LocalObjectCache:
+    """
+    Copies of coordinates.json and templates/*.pdf on local disk, laid out as
+    in the bucket under `directory`. A copy is only used when its MD5 matches
+    the one GCS reports for the object's current generation, so checking
+    freshness needs object metadata (which listings already carry), never a
+    download. Files already in the directory, such as the templates baked into
+    the image, act as a pre-seeded cache: they are matched by content, so they
+    are used under any file name. Objects without an MD5 (composite objects)
+    are always downloaded.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._by_md5 = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _md5(data):
+        return base64.b64encode(hashlib.md5(data).digest()).decode()
+
+    def _index(self):
+        """Maps the MD5 of every file already in the cache directory to its path."""
+        if self._by_md5 is None:
+            paths = [os.path.join(self.directory, 'coordinates.json')]
+            templates_dir = os.path.join(self.directory, 'templates')
+            if os.path.isdir(templates_dir):
+                paths += [os.path.join(templates_dir, name) for name in sorted(os.listdir(templates_dir)) if name.endswith('.pdf')]
+            self._by_md5 = {}
+            for path in paths:
+                if os.path.isfile(path):
+                    with open(path, 'rb') as f:
+                        self._by_md5.setdefault(self._md5(f.read()), path)
+        return self._by_md5
+
+    def read(self, blob):
+        """Returns the cached bytes of the blob's current generation, or None."""
+        if not blob.md5_hash:
+            return None
+        with self._lock:
+            path = self._index().get(blob.md5_hash)
+        if path is None:
+            return None
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        return data if self._md5(data) == blob.md5_hash else None
+
+    def write(self, blob_name, data):
+        path = os.path.join(self.directory, blob_name)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        except OSError as e:
+            app.logger.warning(f"Could not write '{blob_name}' to the local cache: {e}")
+            return
+        with self._lock:
+            self._index()[self._md5(data)] = path
+
+    def fetch(self, blob):
+        """Returns the blob's bytes from the local cache if it is fresh, else downloads and caches them."""
+        data = self.read(blob)
+        if data is not None:
+            app.logger.info(f"Using local cached copy of '{blob.name}'.")
+            return data
+        data = blob.download_as_bytes()
+        self.write(blob.name, data)
+        return data
+
+
+local_cache = LocalObjectCache(LOCAL_CACHE_DIR) if LOCAL_CACHE_DIR else None
+
+
+def fetch_blob(blob):
+    """Returns a blob's bytes, through the local cache when one is configured."""
+    if local_cache is not None:
+        return local_cache.fetch(blob)
+    return blob.download_as_bytes()
+
+
+def load_template_blob(blob):
+    """Fetches and parses one template blob; returns `(data, reader, download_ms, parse_ms)`."""
+    start_time = time.perf_counter()
+    data = fetch_blob(blob)
+    if TEMPLATE_MMAP_DIR:
+        # Map before parsing: the reader keeps a stream over what it parsed.
+        data = map_pdf_bytes(data)
+    downloaded_time = time.perf_counter()
+    reader = parse_pdf_bytes(data)
+    return data, reader, (downloaded_time - start_time) * 1000, (time.perf_counter() - downloaded_time) * 1000
+
 
 try:
-    if not BUCKET_NAME:
+    if IS_RENDER_WORKER:
+        pass
+    elif not BUCKET_NAME:
         logging.critical("FATAL: GCS_BUCKET_NAME environment variable not set.")
     else:
         storage_client = storage.Client()
         bucket = storage_client.bucket(BUCKET_NAME)
         app.logger.info(f"Successfully connected to GCS bucket: '{BUCKET_NAME}'")
 
-        blob_coords = bucket.blob('coordinates.json')
-        COORDINATES = json.loads(blob_coords.download_as_string())
-        app.logger.info("Successfully loaded coordinates.json from GCS.")
+        # coordinates.json and the templates are fetched concurrently, with at
+        # most STARTUP_DOWNLOAD_CONCURRENCY downloads in flight.
+        startup_time = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=STARTUP_DOWNLOAD_CONCURRENCY) as startup_loader:
+            blob_coords = bucket.get_blob('coordinates.json') if local_cache is not None else bucket.blob('coordinates.json')
+            coordinates_future = startup_loader.submit(fetch_blob, blob_coords)
+
+            template_blobs = {} if TEMPLATE_LOADING == 'lazy' else {
+                os.path.splitext(os.path.basename(blob.name))[0]: blob
+                for blob in storage_client.list_blobs(BUCKET_NAME, prefix='templates/')
+                if blob.name.endswith('.pdf')
+            }
+            template_futures = {name: startup_loader.submit(load_template_blob, blob) for name, blob in template_blobs.items()}
 
-        blobs_templates = storage_client.list_blobs(BUCKET_NAME, prefix='templates/')
-        for blob in blobs_templates:
-            if blob.name.endswith('.pdf'):
-                template_name = os.path.splitext(os.path.basename(blob.name))[0]
-                PDF_TEMPLATE_CACHE[template_name] = io.BytesIO(blob.download_as_bytes())
-                app.logger.info(f"Cached template from GCS: '{blob.name}'")
+            snapshot = TemplateSnapshot(json.loads(coordinates_future.result()), blob_coords.generation)
+            app.logger.info(f"Successfully loaded coordinates.json from GCS and compiled {len(snapshot.render_plans)} render plans.")
+
+            if TEMPLATE_LOADING == 'lazy':
+                prewarm_futures = {name: startup_loader.submit(snapshot.ensure_template, name) for name in PREWARM_TEMPLATES}
+                for template_name, future in prewarm_futures.items():
+                    if not future.result():
+                        app.logger.warning(f"Pre-warm template 'templates/{template_name}.pdf' not found in GCS.")
+                app.logger.info(f"Templates load on first use; pre-warmed {len(snapshot.parsed)} of {len(PREWARM_TEMPLATES)}.")
+            else:
+                for template_name, future in template_futures.items():
+                    blob = template_blobs[template_name]
+                    data, reader, download_ms, parse_ms = future.result()
+                    snapshot.add_template(template_name, data, reader, blob.generation)
+                    app.logger.info(f"Cached and parsed template from GCS: '{blob.name}' (download {download_ms:.1f} ms, parse {parse_ms:.1f} ms)")
+        template_snapshot = snapshot
+        app.logger.info(f"Startup loading finished in {(time.perf_counter() - startup_time) * 1000:.1f} ms.")
 
 except Exception as e:
     logging.critical(f"FATAL STARTUP ERROR: Could not initialize Google Cloud services. Error: {e}", exc_info=True)
 
+
+def refresh_template_snapshot():
+    """
+    Compares the GCS generations of coordinates.json and the templates with
+    the current snapshot and, if anything changed, builds and publishes a new
+    snapshot. Only changed objects are downloaded and parsed; unchanged
+    templates are shared with the old snapshot. With lazy loading only the
+    templates loaded so far are tracked. Returns whether a new snapshot was
+    published.
+    """
+    global template_snapshot
+    current = template_snapshot
+
+    blob_coords = bucket.get_blob('coordinates.json')
+    if blob_coords is None:
+        app.logger.warning("coordinates.json is missing from GCS, keeping the loaded templates.")
+        return False
+    template_blobs = {
+        os.path.splitext(os.path.basename(blob.name))[0]: blob
+        for blob in storage_client.list_blobs(BUCKET_NAME, prefix='templates/')
+        if blob.name.endswith('.pdf')
+    }
+    if TEMPLATE_LOADING == 'lazy':
+        template_blobs = {name: blob for name, blob in template_blobs.items() if name in current.parsed}
+
+    coordinates_changed = blob_coords.generation != current.coordinates_generation
+    changed = [name for name, blob in template_blobs.items() if blob.generation != current.generations.get(name)]
+    removed = [name for name in current.parsed if name not in template_blobs]
+    if not (coordinates_changed or changed or removed):
+        return False
+
+    coordinates = json.loads(fetch_blob(blob_coords)) if coordinates_changed else current.coordinates
+    snapshot = TemplateSnapshot(coordinates, blob_coords.generation)
+    for name in template_blobs:
+        if name not in changed:
+            snapshot.copy_template(current, name)
+    with ThreadPoolExecutor(max_workers=STARTUP_DOWNLOAD_CONCURRENCY) as loader:
+        for name, (data, reader, _, _) in zip(changed, loader.map(load_template_blob, [template_blobs[name] for name in changed])):
+            snapshot.add_template(name, data, reader, template_blobs[name].generation)
+
+    template_snapshot = snapshot
+    request_render_pool()
+    app.logger.info(f"Published new template snapshot: coordinates {'reloaded' if coordinates_changed else 'unchanged'}, "
+                    f"templates updated {changed}, removed {removed}.")
+    return True
+
+
+class TemplateRefresher:
+    """
+    Background thread that calls refresh_template_snapshot every `interval`
+    seconds, so new coordinates and templates go live without a redeploy.
+    Requests already running keep the snapshot they started with.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='template-refresher', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            try:
+                refresh_template_snapshot()
+            except Exception as e:
+                app.logger.error(f"Template refresh failed, keeping the current snapshot: {e}")
+
+
+template_refresher = None
+
+class GoogleIdTokenVerifier:
+    """
+    Verifies Google-signed ID tokens against a locally cached certificate set.
+    Certificates are refetched only when their Cache-Control max-age runs out,
+    or when a token is signed with a key id we have not seen yet (key rotation).
+    Tokens that already passed verification are remembered in a bounded LRU
+    until their own `exp`, so repeated calls with the same token skip the
+    signature check entirely.
+    """
+
+    DEFAULT_CERTS_MAX_AGE = 300
+    MIN_CERTS_REFRESH_INTERVAL = 30
+
+    def __init__(self, certs_url=GOOGLE_CERTS_URL, cache_size=TOKEN_CACHE_SIZE):
+        self._certs_url = certs_url
+        self._cache_size = cache_size
+        self._request = requests.Request()
+        self._certs = {}
+        self._certs_expiry = 0
+        self._certs_fetched_at = 0
+        self._certs_lock = threading.Lock()
+        self._verified = OrderedDict()
+        self._verified_lock = threading.Lock()
+
+    def _fetch_certs(self):
+        response = self._request(self._certs_url, method='GET')
+        if response.status != 200:
+            raise google_auth_exceptions.TransportError(
+                f"Could not fetch certificates at {self._certs_url} (HTTP {response.status})")
+
+        max_age = self.DEFAULT_CERTS_MAX_AGE
+        match = re.search(r'max-age=(\d+)', response.headers.get('Cache-Control', ''))
+        if match:
+            max_age = int(match.group(1))
+
+        now = time.time()
+        self._certs = json.loads(response.data.decode('utf-8'))
+        self._certs_expiry = now + max_age
+        self._certs_fetched_at = now
+        app.logger.info(f"Fetched {len(self._certs)} Google signing certificates, valid for {max_age}s.")
+
+    def _get_certs(self, key_id):
+        with self._certs_lock:
+            now = time.time()
+            expired = now >= self._certs_expiry
+            unknown_key = (key_id is not None and key_id not in self._certs
+                           and now - self._certs_fetched_at >= self.MIN_CERTS_REFRESH_INTERVAL)
+            if expired or unknown_key:
+                self._fetch_certs()
+            return self._certs
+
+    def verify(self, token, audience):
+        cache_key = (audience, hashlib.sha256(token.encode('utf-8')).hexdigest())
+        now = time.time()
+
+        with self._verified_lock:
+            claims = self._verified.get(cache_key)
+            if claims is not None:
+                if claims['exp'] > now:
+                    self._verified.move_to_end(cache_key)
+                    return claims
+                del self._verified[cache_key]
+
+        certs = self._get_certs(jwt.decode_header(token).get('kid'))
+        claims = jwt.decode(token, certs=certs, audience=audience)
+        if claims.get('iss') not in GOOGLE_ISSUERS:
+            raise ValueError(f"Wrong issuer. 'iss' should be one of the following: {list(GOOGLE_ISSUERS)}")
+
+        with self._verified_lock:
+            self._verified[cache_key] = claims
+            while len(self._verified) > self._cache_size:
+                self._verified.popitem(last=False)
+        return claims
+
+
+token_verifier = GoogleIdTokenVerifier()
+
+
 @app.before_request
 def verify_google_id_token():
     if request.endpoint and ('static' in request.endpoint or 'flasgger' in request.endpoint):
@@ -82,9 +746,8 @@ def verify_google_id_token():
              app.logger.critical("FATAL: SERVICE_URL environment variable is not set. This must be the full URL of the deployed Cloud Run service.")
              return jsonify({"error": "Server configuration error: Audience not configured."}), 500
 
-        claims = id_token.verify_oauth2_token(
-            token, requests.Request(), audience=AUDIENCE
-        )
+        claims = token_verifier.verify(token, AUDIENCE)
+        g.caller = claims.get('email')
         app.logger.info(f"Authenticated call from: {claims.get('email', 'unknown service account')}")
 
     except ValueError as e:
@@ -95,6 +758,1104 @@ def verify_google_id_token():
         return jsonify({"error": "An unexpected server error occurred during authentication."}), 500
 
 
+def latest_contract_path(nipt):
+    return f"{CONTRACT_LATEST_PREFIX}{nipt}.json"
+
+
+def list_contract_paths(nipt):
+    """Lists every contract stored for a NIPT, in lexicographic (= timestamp) order."""
+    return sorted(blob.name for blob in storage_client.list_blobs(BUCKET_NAME, prefix=f"contracts/{nipt}_"))
+
+
+def load_latest_contract(nipt):
+    """
+    Returns the path of the NIPT's most recent contract, or None, from its
+    small "latest" pointer object. A missing pointer is rebuilt once from a
+    prefix listing, which also covers contracts uploaded before it existed.
+    """
+    try:
+        return json.loads(bucket.blob(latest_contract_path(nipt)).download_as_bytes())['latest']
+    except gcs_exceptions.NotFound:
+        return rebuild_latest_contract(nipt)
+
+
+def rebuild_latest_contract(nipt):
+    contracts = list_contract_paths(nipt)
+    if not contracts:
+        return None
+    try:
+        bucket.blob(latest_contract_path(nipt)).upload_from_string(
+            json.dumps({"latest": contracts[-1]}), content_type='application/json', if_generation_match=0)
+        app.logger.info(f"Rebuilt latest contract pointer for NIPT {nipt} from {len(contracts)} contracts.")
+    except gcs_exceptions.PreconditionFailed:
+        return load_latest_contract(nipt)
+    return contracts[-1]
+
+
+def drop_latest_contract(nipt):
+    """Deletes a pointer that may be out of date so the next lookup rebuilds it."""
+    try:
+        bucket.blob(latest_contract_path(nipt)).delete()
+    except gcs_exceptions.NotFound:
+        pass
+
+
+latest_contract_locks = [threading.Lock() for _ in range(CONTRACT_LATEST_LOCK_STRIPES)]
+pending_latest_contracts = {}
+pending_latest_contracts_lock = threading.Lock()
+
+
+def advance_latest_contract(nipt, blob_path):
+    """
+    Moves the NIPT's latest pointer forward to `blob_path`. The pointer only
+    ever moves to a larger (= newer) name, so a write is skipped when it
+    already points at or past it, and the write is guarded by a generation
+    precondition so writers on other instances cannot move it backwards. A
+    lost race is retried after a jittered, exponentially growing delay; once
+    every attempt is lost the last PreconditionFailed is raised.
+    """
+    pointer = bucket.blob(latest_contract_path(nipt))
+    for attempt in range(CONTRACT_LATEST_RETRIES):
+        try:
+            target = blob_path
+            try:
+                if json.loads(pointer.download_as_bytes())['latest'] >= blob_path:
+                    return
+                generation = pointer.generation
+            except gcs_exceptions.NotFound:
+                # First pointer for this NIPT: it starts at the newest contract there is.
+                target, generation = max([blob_path] + list_contract_paths(nipt)[-1:]), 0
+            pointer.upload_from_string(json.dumps({"latest": target}), content_type='application/json',
+                                       if_generation_match=generation)
+            return
+        except (gcs_exceptions.PreconditionFailed, gcs_exceptions.TooManyRequests):
+            if attempt == CONTRACT_LATEST_RETRIES - 1:
+                raise
+            time.sleep(random.uniform(0, min(CONTRACT_LATEST_MAX_BACKOFF, CONTRACT_LATEST_BACKOFF * 2 ** attempt)))
+
+
+def flush_latest_contract(nipt):
+    """
+    Advances a NIPT's pointer past every contract queued for it. Updates of a
+    NIPT are serialized within this process, and whichever thread gets the lock
+    covers all contracts queued so far with a single write, so a batch for one
+    customer costs one or two small writes. Contracts whose write lost every
+    race stay queued and are flushed again a little later.
+    """
+    with latest_contract_locks[hash(nipt) % CONTRACT_LATEST_LOCK_STRIPES]:
+        with pending_latest_contracts_lock:
+            entries = pending_latest_contracts.pop(nipt, [])
+        if not entries:
+            return
+        try:
+            advance_latest_contract(nipt, max(path for path, _ in entries))
+        except Exception as e:
+            if isinstance(e, gcs_exceptions.PreconditionFailed):
+                with pending_latest_contracts_lock:
+                    pending_latest_contracts.setdefault(nipt, []).extend((path, None) for path, _ in entries)
+                retry = threading.Timer(CONTRACT_LATEST_MAX_BACKOFF, flush_latest_contract, (nipt,))
+                retry.daemon = True
+                retry.start()
+            for _, future in entries:
+                if future is not None:
+                    future.set_exception(e)
+        else:
+            for _, future in entries:
+                if future is not None:
+                    future.set_result(None)
+
+
+def record_contract(nipt, blob_path):
+    """Moves the NIPT's latest pointer to a freshly uploaded contract (see flush_latest_contract)."""
+    recorded = Future()
+    with pending_latest_contracts_lock:
+        pending_latest_contracts.setdefault(nipt, []).append((blob_path, recorded))
+    flush_latest_contract(nipt)
+    # Done by now: the thread that took this entry finished it before releasing the lock.
+    recorded.result()
+
+
+def iter_blob_contents(blobs, max_workers=ZIP_DOWNLOAD_CONCURRENCY, max_inflight_bytes=ZIP_MAX_INFLIGHT_BYTES):
+    """
+    Downloads blobs over a bounded thread pool and yields `(blob, content)` pairs
+    in completion order. A new download only starts while the listed sizes of
+    the downloads in flight stay under `max_inflight_bytes`; a single blob
+    larger than the cap is still fetched, just on its own.
+    """
+    waiting = deque(blobs)
+    pending = {}
+    inflight_bytes = 0
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while waiting or pending:
+            while waiting and len(pending) < max_workers and (
+                    not pending or inflight_bytes + (waiting[0].size or 0) <= max_inflight_bytes):
+                blob = waiting.popleft()
+                pending[executor.submit(blob.download_as_bytes)] = blob
+                inflight_bytes += blob.size or 0
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                blob = pending.pop(future)
+                inflight_bytes -= blob.size or 0
+                yield blob, future.result()
+
+
+class ZipChunkBuffer(io.RawIOBase):
+    """
+    Write-only, unseekable sink for `zipfile.ZipFile`. Because it cannot seek,
+    zipfile writes each entry with a trailing data descriptor instead of
+    patching its local header afterwards, so everything written so far can be
+    drained and sent to the client right away.
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self._offset = 0
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self._offset
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._offset += len(data)
+        return len(data)
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def attachment_filename_options(download_name):
+    """
+    Content-Disposition filename options for `download_name`, built the way
+    send_file builds them: a non-ASCII name gets an ASCII fallback plus an
+    RFC 2231 `filename*`, so the header stays encodable and unambiguous.
+    """
+    try:
+        download_name.encode('ascii')
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize('NFKD', download_name).encode('ascii', 'ignore').decode('ascii')
+        return {'filename': simple, 'filename*': f"UTF-8''{quote(download_name, safe='!#$&+^`|~')}"}
+    return {'filename': download_name}
+
+
+def stream_contracts_zip(nipt, blobs):
+    """Yields a ZIP archive of the given contracts chunk by chunk, one entry per downloaded PDF."""
+    sink = ZipChunkBuffer()
+    try:
+        with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for blob, pdf_content in iter_blob_contents(blobs):
+                zf.writestr(os.path.basename(blob.name), pdf_content)
+                yield sink.drain()
+        yield sink.drain()
+    except Exception as e:
+        app.logger.error(f"ZIP stream for NIPT {nipt} aborted after {sink.tell()} bytes: {e}", exc_info=True)
+        raise
+
+
+def find_missing_template(snapshot, template_names):
+    """Returns an error message for the first template without coordinates or a cached PDF, or None."""
+    for template_name in template_names:
+        if template_name not in snapshot.render_plans:
+            if snapshot.coordinates.get(template_name):
+                return f"Coordinates for template '{template_name}' are invalid."
+            return f"Coordinates for template '{template_name}' not found."
+        if TEMPLATE_LOADING == 'lazy':
+            loaded = snapshot.ensure_template(template_name)
+        else:
+            loaded = template_name in snapshot.parsed
+        if not loaded:
+            return f"Template PDF '{template_name}.pdf' not found in cache."
+    return None
+
+
+NIPT_MAX_LENGTH = 64
+
+
+def find_invalid_nipt(context):
+    """Returns an error message if `customer_nipt` cannot be part of a contract's object name, or None."""
+    if 'customer_nipt' not in context:
+        return None
+    nipt = context['customer_nipt']
+    if not isinstance(nipt, (str, int)) or isinstance(nipt, bool):
+        return "'customer_nipt' must be a string."
+    nipt = str(nipt)
+    if not 0 < len(nipt) <= NIPT_MAX_LENGTH:
+        return f"'customer_nipt' must be between 1 and {NIPT_MAX_LENGTH} characters."
+    if nipt.startswith('.') or '/' in nipt or any(unicodedata.category(char).startswith('C') for char in nipt):
+        return "'customer_nipt' may not start with '.' or contain '/' or control characters."
+    return None
+
+
+def prepare_context(context):
+    if 'doc_date' in context:
+        try:
+            datetime.strptime(str(context['doc_date']), '%d-%m-%Y')
+        except (ValueError, TypeError):
+            app.logger.warning(f"Could not validate doc_date format: '{context.get('doc_date')}'. Using original value.")
+            pass
+
+    if 'customer_address' in context and 'customer_city' in context:
+        context['customer_full_address'] = f'{context["customer_address"]}, {context["customer_city"]}'
+
+
+def _canonical_digest(payload):
+    canonical = json.dumps(payload, sort_keys=True, separators=(',', ':'), ensure_ascii=False, default=str)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+OVERLAY_FONT_SIZE = 12
+OVERLAY_FONT = DictionaryObject({
+    NameObject('/Type'): NameObject('/Font'),
+    NameObject('/Subtype'): NameObject('/Type1'),
+    NameObject('/BaseFont'): NameObject('/Helvetica'),
+    NameObject('/Encoding'): NameObject('/WinAnsiEncoding'),
+})
+
+
+def _pdf_number(value):
+    return ('%.4f' % value).rstrip('0').rstrip('.')
+
+
+def _pdf_string(text):
+    encoded = bytearray(b'(')
+    for byte in text.encode('cp1252', 'replace'):
+        if byte in b'()\\':
+            encoded += b'\\' + bytes([byte])
+        elif 32 <= byte < 127:
+            encoded.append(byte)
+        else:
+            encoded += b'\\%03o' % byte
+    encoded += b')'
+    return bytes(encoded)
+
+
+def _text_width(text):
+    # Imported on first use: only centred fields need reportlab's font metrics.
+    from reportlab.pdfbase.pdfmetrics import stringWidth
+    return stringWidth(text, 'Helvetica', OVERLAY_FONT_SIZE)
+
+
+def build_overlay_content(draws, font_name):
+    """
+    Returns content-stream operators drawing `(x, y, text, align)` draws in
+    Helvetica 12, the font and size the original reportlab overlays used.
+    """
+    operators = [b'q', b'BT', b'%s %d Tf' % (font_name.encode(), OVERLAY_FONT_SIZE)]
+    for x, y, text, align in draws:
+        if align == 'center':
+            x -= _text_width(text) / 2
+        operators.append(b'1 0 0 1 %s %s Tm %s Tj' % (_pdf_number(x).encode(), _pdf_number(y).encode(), _pdf_string(text)))
+    operators += [b'ET', b'Q']
+    return b'\n'.join(operators) + b'\n'
+
+
+def _resolved_dict(dictionary, key):
+    return dictionary[key] if key in dictionary else DictionaryObject()
+
+
+def _overlay_font_name(page):
+    fonts = _resolved_dict(_resolved_dict(page, '/Resources'), '/Font')
+    font_name, suffix = '/CGOverlay', 1
+    while font_name in fonts:
+        font_name, suffix = f'/CGOverlay{suffix}', suffix + 1
+    return font_name
+
+
+def _content_refs(page):
+    if '/Contents' not in page:
+        return []
+    contents = page.raw_get('/Contents')
+    if isinstance(contents.get_object(), ArrayObject):
+        return list(contents.get_object())
+    return [contents]
+
+
+def _resources_with_font(page, font_name, font_ref):
+    resources = DictionaryObject(_resolved_dict(page, '/Resources'))
+    fonts = DictionaryObject(_resolved_dict(resources, '/Font'))
+    fonts[NameObject(font_name)] = font_ref
+    resources[NameObject('/Font')] = fonts
+    return resources
+
+
+def stamp_page(writer, page, draws, font_ref):
+    """
+    Stamps draws onto a page already added to `writer` by appending content
+    streams around its existing ones: `[q, ...original, Q + overlay]`. The
+    original streams are neither decoded nor rewritten, and `font_ref` is the
+    writer's shared overlay font object.
+    """
+    font_name = _overlay_font_name(page)
+    open_stream = DecodedStreamObject()
+    open_stream.set_data(b'q\n')
+    overlay_stream = DecodedStreamObject()
+    overlay_stream.set_data(b'Q\n' + build_overlay_content(draws, font_name))
+
+    contents = [ref if isinstance(ref, IndirectObject) else writer._add_object(ref) for ref in _content_refs(page)]
+    page[NameObject('/Contents')] = ArrayObject(
+        [writer._add_object(open_stream), *contents, writer._add_object(overlay_stream.flate_encode())])
+    page[NameObject('/Resources')] = _resources_with_font(page, font_name, font_ref)
+
+
+def _find_startxref(data):
+    position = data.rfind(b'startxref')
+    return int(data[position + len(b'startxref'):].split()[0])
+
+
+def incremental_xref_format(document):
+    """
+    Returns how the last cross-reference section of a base document is
+    stored: 'table' for a classic xref table, 'stream' for a cross-reference
+    stream, or None when no incremental update can be written on top of it.
+    """
+    data = document.data
+    if document.reader.is_encrypted:
+        return None
+    try:
+        tail = data[_find_startxref(data):]
+    except (ValueError, IndexError):
+        return None
+    if tail.startswith(b'xref'):
+        return 'table'
+    if re.match(rb'\d+\s+\d+\s+obj', tail):
+        return 'stream'
+    return None
+
+
+def render_incremental_update(document, draws_by_page, xref_format):
+    """
+    Returns the base document bytes, unchanged, followed by one PDF
+    incremental-update section. The section only holds a font object, an
+    opening `q` and an overlay stream per stamped page, and the stamped page
+    objects themselves, rewritten to reference them. Every other object of
+    the base is reused through the previous cross-reference section, which
+    the new one extends in the same format (`xref_format`).
+    """
+    original = document.data
+    reader = document.reader
+    base_offset = len(original) + 1
+    update = io.BytesIO()
+    offsets = {}
+    known_ids = [idnum for objects in reader.xref.values() for idnum in objects] + list(reader.xref_objStm)
+    next_id = max([int(reader.trailer.get('/Size', 0))] + [idnum + 1 for idnum in known_ids])
+
+    def begin_object(idnum, generation=0):
+        offsets[idnum] = (base_offset + update.tell(), generation)
+        update.write(b'%d %d obj\n' % (idnum, generation))
+
+    def write_stream(idnum, content):
+        data = zlib.compress(content)
+        begin_object(idnum)
+        update.write(b'<< /Length %d /Filter /FlateDecode >>\nstream\n' % len(data))
+        update.write(data)
+        update.write(b'\nendstream\nendobj\n')
+
+    font_id, next_id = next_id, next_id + 1
+    begin_object(font_id)
+    OVERLAY_FONT.write_to_stream(update, None)
+    update.write(b'\nendobj\n')
+
+    for page_index, draws in sorted(draws_by_page.items()):
+        if page_index >= len(reader.pages):
+            continue
+        page = reader.pages[page_index]
+        font_name = _overlay_font_name(page)
+        open_id, overlay_id, next_id = next_id, next_id + 1, next_id + 2
+        write_stream(open_id, b'q\n')
+        write_stream(overlay_id, b'Q\n' + build_overlay_content(draws, font_name))
+
+        stamped_page = DictionaryObject(page)
+        stamped_page[NameObject('/Contents')] = ArrayObject(
+            [IndirectObject(open_id, 0, reader), *_content_refs(page), IndirectObject(overlay_id, 0, reader)])
+        stamped_page[NameObject('/Resources')] = _resources_with_font(page, font_name, IndirectObject(font_id, 0, reader))
+        page_ref = page.indirect_reference
+        begin_object(page_ref.idnum, page_ref.generation)
+        stamped_page.write_to_stream(update, None)
+        update.write(b'\nendobj\n')
+
+    xref_offset = base_offset + update.tell()
+    trailer = DictionaryObject({NameObject('/Prev'): NumberObject(_find_startxref(original))})
+    for key in ('/Root', '/Info'):
+        if key in reader.trailer:
+            trailer[NameObject(key)] = reader.trailer.raw_get(key)
+    # The first /ID element identifies the file it was derived from and is
+    # kept; the second must change with every update. Hashing the objects this
+    # update adds gives each contract its own while keeping output deterministic.
+    instance_id = ByteStringObject(hashlib.md5(update.getvalue()).digest())
+    original_ids = reader.trailer.get('/ID')
+    permanent_id = original_ids[0] if original_ids else instance_id
+    trailer[NameObject('/ID')] = ArrayObject([permanent_id, instance_id])
+
+    if xref_format == 'stream':
+        # The cross-reference stream is an object itself and lists its own offset.
+        xref_id, next_id = next_id, next_id + 1
+        offsets[xref_id] = (xref_offset, 0)
+
+    runs = []
+    object_ids = sorted(offsets)
+    run_start = 0
+    for i in range(1, len(object_ids) + 1):
+        if i == len(object_ids) or object_ids[i] != object_ids[i - 1] + 1:
+            runs.append(object_ids[run_start:i])
+            run_start = i
+    trailer[NameObject('/Size')] = NumberObject(next_id)
+
+    if xref_format == 'stream':
+        entries = b''.join(b'\x01' + offsets[idnum][0].to_bytes(4, 'big') + offsets[idnum][1].to_bytes(2, 'big')
+                           for run in runs for idnum in run)
+        data = zlib.compress(entries)
+        trailer[NameObject('/Type')] = NameObject('/XRef')
+        trailer[NameObject('/W')] = ArrayObject([NumberObject(1), NumberObject(4), NumberObject(2)])
+        trailer[NameObject('/Index')] = ArrayObject(
+            [NumberObject(number) for run in runs for number in (run[0], len(run))])
+        trailer[NameObject('/Filter')] = NameObject('/FlateDecode')
+        trailer[NameObject('/Length')] = NumberObject(len(data))
+        update.write(b'%d 0 obj\n' % xref_id)
+        trailer.write_to_stream(update, None)
+        update.write(b'\nstream\n' + data + b'\nendstream\nendobj\n')
+    else:
+        update.write(b'xref\n')
+        for run in runs:
+            update.write(b'%d %d\n' % (run[0], len(run)))
+            for idnum in run:
+                update.write(b'%010d %05d n\r\n' % offsets[idnum])
+        update.write(b'trailer\n')
+        trailer.write_to_stream(update, None)
+        update.write(b'\n')
+    update.write(b'startxref\n%d\n%%%%EOF\n' % xref_offset)
+
+    return b''.join((original, b'\n', update.getvalue()))
+
+
+def build_template_bundle(snapshot, template_names):
+    """
+    Concatenates the pages of several templates into one base document, in
+    order, and parses it like a template. `page_ranges` maps each template to
+    its pages in the bundle.
+    """
+    writer = PdfWriter()
+    page_ranges = []
+    for template_name in template_names:
+        start = len(writer.pages)
+        for page in snapshot.parsed[template_name].pages:
+            writer.add_page(page)
+        page_ranges.append(range(start, len(writer.pages)))
+    # A stable file identifier, so incremental outputs of the same bundle
+    # share the first /ID element like outputs of a single template do.
+    bundle_id = ByteStringObject(hashlib.md5(' '.join(snapshot.digests[name] for name in template_names).encode()).digest())
+    writer._ID = ArrayObject([bundle_id, bundle_id])
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    data = buffer.getvalue()
+    if TEMPLATE_MMAP_DIR:
+        data = map_pdf_bytes(data)
+    return BaseDocument(data, parse_pdf_bytes(data), tuple(page_ranges))
+
+
+def get_base_document(snapshot, template_names):
+    """
+    Returns the document an incremental update is written on top of: the
+    template itself for a single template, otherwise the pre-merged bundle for
+    that ordered list of templates, built on first use and kept in a small
+    per-snapshot LRU cache.
+    """
+    if len(template_names) == 1:
+        template_name = template_names[0]
+        reader = snapshot.parsed[template_name]
+        return BaseDocument(snapshot.pdf_bytes[template_name], reader, (range(len(reader.pages)),))
+
+    key = tuple(template_names)
+    with snapshot.bundles_lock:
+        document = snapshot.bundles.get(key)
+        if document is None:
+            start_time = time.perf_counter()
+            document = build_template_bundle(snapshot, template_names)
+            app.logger.info(f"Built template bundle {list(key)} ({len(document.data)} bytes) in {(time.perf_counter() - start_time) * 1000:.1f} ms.")
+            snapshot.bundles[key] = document
+            while len(snapshot.bundles) > TEMPLATE_BUNDLE_CACHE_SIZE:
+                snapshot.bundles.popitem(last=False)
+        else:
+            snapshot.bundles.move_to_end(key)
+    return document
+
+
+def render_pdf(template_names, context, snapshot=None):
+    """
+    Stamps a prepared context onto the given templates and returns the
+    assembled PDF bytes. Uses the current template snapshot unless one is given.
+    """
+    snapshot = snapshot or template_snapshot
+    draws = [bind_render_plan(snapshot.render_plans[name], context) for name in template_names]
+
+    if len(template_names) == 1 and not draws[0]:
+        # Nothing lands on any page: the template itself is the document.
+        return bytes(snapshot.pdf_bytes[template_names[0]])
+    if OUTPUT_MODE == 'incremental':
+        document = get_base_document(snapshot, template_names)
+        draws_by_page = {}
+        for pages, template_draws in zip(document.page_ranges, draws):
+            for i, page_draws in template_draws.items():
+                if i < len(pages):
+                    draws_by_page[pages[i]] = page_draws
+        if not draws_by_page:
+            return bytes(document.data)
+        xref_format = incremental_xref_format(document)
+        if xref_format:
+            return render_incremental_update(document, draws_by_page, xref_format)
+
+    # Rewriting clones every page into a fresh writer whatever it is cloned
+    # from, so the templates are concatenated right here; a pre-merged bundle
+    # would save no work, only keep another copy of their pages around.
+    writer = PdfWriter()
+    font_ref = writer._add_object(DictionaryObject(OVERLAY_FONT)) if any(draws) else None
+
+    for template_name, draws_by_page in zip(template_names, draws):
+        for i, page in enumerate(snapshot.parsed[template_name].pages):
+            # add_page clones the shared template page into this writer at the
+            # object level: content streams keep their original encoded bytes
+            # and are never decoded, so untouched pages pass through as-is.
+            # Only the clone of a page with draws is stamped.
+            page = writer.add_page(page)
+            if i in draws_by_page:
+                stamp_page(writer, page, draws_by_page[i], font_ref)
+
+    final_buffer = io.BytesIO()
+    writer.write(final_buffer)
+    return final_buffer.getvalue()
+
+
+render_pool = None
+render_pool_snapshot = None
+render_pool_templates = frozenset()
+render_pool_lock = threading.Lock()
+
+
+class RenderWorkerProcess(multiprocessing.context.SpawnProcess):
+    """A spawned render worker, named so that IS_RENDER_WORKER is set when it imports this module."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.name = RENDER_WORKER_NAME
+
+
+class RenderWorkerContext(multiprocessing.context.SpawnContext):
+    Process = RenderWorkerProcess
+
+
+def _init_render_worker(coordinates, coordinates_generation, templates):
+    """Pool initializer: installs the parent's template snapshot, given as `{name: (bytes, generation)}`."""
+    global template_snapshot
+    snapshot = TemplateSnapshot(coordinates, coordinates_generation)
+    for template_name, (data, generation) in templates.items():
+        if TEMPLATE_MMAP_DIR:
+            data = map_pdf_bytes(data)
+        snapshot.add_template(template_name, data, parse_pdf_bytes(data), generation)
+    template_snapshot = snapshot
+
+
+def _warm_render_worker(_):
+    return os.getpid()
+
+
+class RenderPoolBuilder:
+    """
+    Background thread that keeps the pool of render worker processes used by
+    the 'process' backend in step with the template snapshot. It starts a pool
+    once startup has finished, and a fresh one whenever the snapshot is
+    replaced or templates are loaded into it on demand, since workers only know
+    the templates they were started with. A new pool is warmed up before it is
+    swapped in; the old one is retired, letting it finish what it has queued.
+
+    The workers are spawned rather than forked: a fork could inherit a lock
+    some other thread holds at that instant and hang on it forever. Each one
+    receives the snapshot's coordinates and template bytes through the pool
+    initializer and parses its own copy.
+    """
+
+    RETRY_DELAY = 10
+
+    def __init__(self):
+        self._wanted = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._wanted.set()
+        self._thread = threading.Thread(target=self._run, name='render-pool-builder', daemon=True)
+        self._thread.start()
+
+    def request(self):
+        """Asks for a pool matching the current snapshot; returns right away."""
+        self._wanted.set()
+
+    def stop(self):
+        self._stopping.set()
+        self._wanted.set()
+
+    def _run(self):
+        while True:
+            self._wanted.wait()
+            self._wanted.clear()
+            if self._stopping.is_set():
+                return
+            snapshot = template_snapshot
+            with render_pool_lock:
+                if render_pool_snapshot is snapshot and render_pool_templates.issuperset(snapshot.parsed):
+                    continue
+            try:
+                self._build(snapshot)
+            except Exception as e:
+                app.logger.error(f"Could not start render worker processes, rendering in-thread for now: {e}", exc_info=True)
+                self._stopping.wait(self.RETRY_DELAY)
+
+    def _build(self, snapshot):
+        global render_pool, render_pool_snapshot, render_pool_templates
+        start_time = time.perf_counter()
+        templates = {name: (bytes(snapshot.pdf_bytes[name]), snapshot.generations.get(name)) for name in list(snapshot.parsed)}
+        pool = ProcessPoolExecutor(max_workers=RENDER_PROCESSES, mp_context=RenderWorkerContext(),
+                                   initializer=_init_render_worker,
+                                   initargs=(snapshot.coordinates, snapshot.coordinates_generation, templates))
+        try:
+            list(pool.map(_warm_render_worker, range(RENDER_PROCESSES)))
+        except BaseException:
+            pool.shutdown(wait=False, cancel_futures=True)
+            raise
+
+        with render_pool_lock:
+            retired = render_pool
+            render_pool = pool
+            render_pool_snapshot = snapshot
+            render_pool_templates = frozenset(templates)
+        if retired is not None:
+            retired.shutdown(wait=False)
+        app.logger.info(f"Started {RENDER_PROCESSES} render worker processes with {len(templates)} templates "
+                        f"in {(time.perf_counter() - start_time) * 1000:.1f} ms.")
+
+
+render_pool_builder = None
+
+
+def request_render_pool():
+    if render_pool_builder is not None:
+        render_pool_builder.request()
+
+
+def get_render_pool(snapshot, template_names):
+    """
+    Returns the render pool if it was started from `snapshot` and knows all of
+    `template_names`, otherwise asks the builder for a new one and returns
+    None. Requests never wait for a pool to start; without one they render
+    in-thread, as do requests still holding a replaced snapshot.
+    """
+    if RENDER_BACKEND != 'process' or snapshot is not template_snapshot:
+        return None
+
+    with render_pool_lock:
+        if render_pool is not None and render_pool_snapshot is snapshot and render_pool_templates.issuperset(template_names):
+            return render_pool
+    request_render_pool()
+    return None
+
+
+def discard_render_pool(broken_pool):
+    global render_pool, render_pool_snapshot, render_pool_templates
+    with render_pool_lock:
+        if render_pool is not broken_pool:
+            return
+        app.logger.error("Render worker pool is broken, starting a new one in the background.")
+        broken_pool.shutdown(wait=False, cancel_futures=True)
+        render_pool = None
+        render_pool_snapshot = None
+        render_pool_templates = frozenset()
+    request_render_pool()
+
+
+def submit_render(snapshot, template_names, context):
+    """
+    Renders a prepared context with the configured backend and returns a Future
+    of the PDF bytes. Without a render pool the PDF is rendered right away in
+    the calling thread and the returned Future is already done.
+    """
+    pool = get_render_pool(snapshot, template_names)
+    if pool is not None:
+        try:
+            return pool.submit(render_pdf, template_names, context)
+        except BrokenProcessPool:
+            discard_render_pool(pool)
+        except RuntimeError:
+            # The pool was retired for a newer one after we picked it up.
+            pass
+
+    future = Future()
+    try:
+        future.set_result(render_pdf(template_names, context, snapshot))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
+last_contract_timestamp = 0
+contract_name_lock = threading.Lock()
+
+
+def new_contract_blob_path(nipt):
+    """
+    Returns a fresh contracts/ object path for a NIPT:
+    `{nipt}_{YYYYmmddHHMMSSffffff}-{random}.pdf`. Timestamps handed out by this
+    process strictly increase, and the random suffix keeps names from other
+    instances apart, while names still sort by creation time, after the older
+    second-resolution `{nipt}_{YYYYmmddHHMMSS}.pdf` ones of the same second.
+    """
+    global last_contract_timestamp
+    with contract_name_lock:
+        micros = max(time.time_ns() // 1000, last_contract_timestamp + 1)
+        last_contract_timestamp = micros
+    seconds, micros = divmod(micros, 1000000)
+    timestamp = datetime.fromtimestamp(seconds).strftime('%Y%m%d%H%M%S') + f"{micros:06d}"
+    return f"contracts/{nipt}_{timestamp}-{uuid.uuid4().hex[:8]}.pdf"
+
+
+def publish_contract(nipt, blob_path, pdf_bytes):
+    """
+    Uploads a rendered contract to GCS and moves its NIPT's latest contract pointer to it.
+    Uploads only create objects, never overwrite them; if the name is taken
+    by a different document the contract is published under a new name.
+    Returns the object path it was published as.
+    """
+    md5_hash = base64.b64encode(hashlib.md5(pdf_bytes).digest()).decode()
+    for _ in range(CONTRACT_UPLOAD_ATTEMPTS):
+        try:
+            bucket.blob(blob_path).upload_from_string(pdf_bytes, content_type='application/pdf', if_generation_match=0)
+            break
+        except gcs_exceptions.PreconditionFailed:
+            existing = bucket.get_blob(blob_path)
+            if existing is not None and existing.md5_hash == md5_hash:
+                # An earlier attempt of this same upload already went through.
+                break
+            renamed = new_contract_blob_path(nipt)
+            app.logger.warning(f"Contract name '{blob_path}' is already taken, publishing as '{renamed}'.")
+            blob_path = renamed
+    else:
+        raise RuntimeError(f"Could not find a free contract name for NIPT {nipt} after {CONTRACT_UPLOAD_ATTEMPTS} attempts.")
+    app.logger.info(f"Successfully uploaded '{os.path.basename(blob_path)}' to GCS.")
+
+    try:
+        record_contract(nipt, blob_path)
+    except gcs_exceptions.PreconditionFailed:
+        # Only lost races: the pointer itself is fine and the entry stays queued.
+        app.logger.warning(f"Latest contract pointer for NIPT {nipt} is busy, it will be moved to '{blob_path}' shortly.")
+    except Exception as e:
+        app.logger.error(f"Could not update latest contract pointer for NIPT {nipt}, dropping it: {e}", exc_info=True)
+        drop_latest_contract(nipt)
+    return blob_path
+
+
+class UploadSpool:
+    """
+    Durable on-disk queue of rendered contracts waiting to be published to GCS.
+    Each entry is a PDF plus a JSON manifest; the manifest is renamed into place
+    last, so only complete entries are ever picked up. A single background
+    thread publishes entries in the order they were spooled, retrying each one
+    with exponential backoff, and deletes it once it is in GCS. Entries left
+    over from a previous process are picked up again on start. An entry that
+    cannot be read, or that GCS rejects with a client error retrying cannot
+    fix (any 4xx but 408 and 429), is renamed to `*.bad` and skipped, so it
+    cannot stop the entries behind it.
+    """
+
+    MAX_RETRY_DELAY = 60
+
+    def __init__(self, directory):
+        self._directory = directory
+        self._queue = queue.Queue()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self):
+        os.makedirs(self._directory, exist_ok=True)
+        leftovers = sorted(name for name in os.listdir(self._directory) if name.endswith('.json'))
+        for name in leftovers:
+            self._queue.put(os.path.join(self._directory, name))
+        if leftovers:
+            app.logger.info(f"Resuming {len(leftovers)} spooled uploads from '{self._directory}'.")
+
+        self._thread = threading.Thread(target=self._run, name='upload-spool', daemon=True)
+        self._thread.start()
+
+    def enqueue(self, nipt, blob_path, pdf_bytes):
+        entry_id = f"{time.time_ns():020d}-{uuid.uuid4().hex}"
+        pdf_path = os.path.join(self._directory, f"{entry_id}.pdf")
+        manifest_path = os.path.join(self._directory, f"{entry_id}.json")
+
+        self._write_durably(pdf_path, pdf_bytes)
+        self._write_durably(manifest_path + '.tmp', json.dumps({"nipt": nipt, "blob_path": blob_path}).encode('utf-8'))
+        os.replace(manifest_path + '.tmp', manifest_path)
+        self._queue.put(manifest_path)
+
+    @staticmethod
+    def _write_durably(path, data):
+        with open(path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _run(self):
+        while True:
+            manifest_path = self._queue.get()
+            try:
+                if manifest_path is None:
+                    return
+                self._publish_with_retries(manifest_path)
+            except Exception as e:
+                app.logger.error(f"Spool entry '{manifest_path}' cannot be published, moving it aside: {e}", exc_info=True)
+                self._set_aside(manifest_path)
+            finally:
+                self._queue.task_done()
+
+    def _publish_with_retries(self, manifest_path):
+        pdf_path = manifest_path[:-len('.json')] + '.pdf'
+        try:
+            with open(manifest_path, 'rb') as f:
+                entry = json.load(f)
+            with open(pdf_path, 'rb') as f:
+                pdf_bytes = f.read()
+        except FileNotFoundError:
+            # With several gunicorn workers sharing the spool directory, each
+            # resumes the same leftovers; another worker already published it
+            # if the manifest is gone (it is removed before the PDF).
+            if os.path.exists(manifest_path):
+                raise
+            return
+        if not (isinstance(entry, dict) and isinstance(entry.get('nipt'), str) and isinstance(entry.get('blob_path'), str)):
+            raise ValueError("manifest must be a JSON object with string 'nipt' and 'blob_path'")
+
+        delay = 1
+        while True:
+            try:
+                publish_contract(entry['nipt'], entry['blob_path'], pdf_bytes)
+                break
+            except Exception as e:
+                if isinstance(e, gcs_exceptions.ClientError) and e.code not in (408, 429):
+                    raise
+                app.logger.warning(f"Spooled upload of '{entry['blob_path']}' failed, retrying in {delay}s: {e}")
+                if self._stopping.wait(delay):
+                    return
+                delay = min(delay * 2, self.MAX_RETRY_DELAY)
+
+        for path in (manifest_path, pdf_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    @staticmethod
+    def _set_aside(manifest_path):
+        for path in (manifest_path, manifest_path[:-len('.json')] + '.pdf'):
+            try:
+                os.replace(path, path + '.bad')
+            except FileNotFoundError:
+                pass
+
+    def stop(self, timeout=UPLOAD_SPOOL_SHUTDOWN_TIMEOUT):
+        """Waits up to `timeout` seconds for pending uploads; whatever is left stays on disk for the next start."""
+        if self._thread is None:
+            return
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.1)
+        pending = self._queue.unfinished_tasks
+        self._stopping.set()
+        self._queue.put(None)
+        self._thread.join(max(0, deadline - time.monotonic()))
+        self._thread = None
+        if pending:
+            app.logger.warning(f"Stopped upload spool with {pending} uploads still pending in '{self._directory}'.")
+
+
+upload_spool = None
+
+
+def upload_contract(context, pdf_bytes):
+    """
+    Publishes a rendered contract under contracts/ and returns its object path.
+    In 'spool' upload mode the PDF is only written to the local spool here and
+    published to GCS in the background.
+    """
+    nipt = context.get('customer_nipt', 'unknown')
+    blob_path = new_contract_blob_path(nipt)
+
+    if upload_spool is not None:
+        upload_spool.enqueue(nipt, blob_path, pdf_bytes)
+        app.logger.info(f"Spooled '{os.path.basename(blob_path)}' for upload to GCS.")
+        return blob_path
+    return publish_contract(nipt, blob_path, pdf_bytes)
+
+
+def render_cache_key(snapshot, template_names, context):
+    """
+    Returns the content address of a render: a hash over the version of every
+    requested template, its coordinates and the canonical JSON of the prepared
+    context. Identical requests map to the same key; changing any input,
+    including a template upload or a coordinates edit, changes it.
+    """
+    return _canonical_digest({
+        'templates': [[name, snapshot.digests.get(name), snapshot.coordinates.get(name)] for name in template_names],
+        'context': context,
+    })
+
+
+class RenderCache:
+    """
+    Remembers recently generated documents by render_cache_key: the PDF bytes
+    and the contracts/ blob they were published as. Entries are evicted least
+    recently used first once their PDFs exceed `max_bytes` in total.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, pdf_bytes, blob_path):
+        if len(pdf_bytes) > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= len(previous[0])
+            self._entries[key] = (pdf_bytes, blob_path)
+            self._size += len(pdf_bytes)
+            while self._size > self.max_bytes:
+                _, (evicted_pdf, _) = self._entries.popitem(last=False)
+                self._size -= len(evicted_pdf)
+
+
+render_cache = RenderCache(RENDER_CACHE_MAX_BYTES)
+
+
+def generate_contract(snapshot, template_names, context):
+    """
+    Renders and publishes one contract, or reuses an identical earlier one
+    from the render cache. Returns `(pdf_bytes, blob_path, cache_key)`.
+    """
+    cache_key = render_cache_key(snapshot, template_names, context)
+    cached = render_cache.get(cache_key)
+    if cached:
+        pdf_bytes, blob_path = cached
+        app.logger.info(f"Render cache hit, returning already uploaded '{blob_path}'.")
+    else:
+        pdf_bytes = submit_render(snapshot, template_names, context).result()
+        blob_path = upload_contract(context, pdf_bytes)
+        render_cache.put(cache_key, pdf_bytes, blob_path)
+    return pdf_bytes, blob_path, cache_key
+
+
+IdempotencyEntry = namedtuple('IdempotencyEntry', ['future', 'expires_at'])
+
+
+class IdempotencyStore:
+    """
+    Tracks Idempotency-Key values seen by /generate-pdf. The first request for
+    a key owns it and resolves the entry's future with `(fingerprint, blob_path,
+    cache_key)`, where `fingerprint` identifies the request body it answered;
+    retries of the same key, including ones arriving while the first is still
+    rendering, wait on that future instead of rendering again. Keys expire
+    after `ttl` seconds and the oldest completed ones are dropped beyond
+    `max_keys`; keys still in flight are never dropped, so the store can run
+    over `max_keys` until they complete.
+
+    With IDEMPOTENCY_STORE='gcs' completed keys are also written under
+    idempotency/ so that retries landing on another instance, or after a
+    restart, are still replayed.
+    """
+
+    def __init__(self, max_keys, ttl, persist):
+        self.max_keys = max_keys
+        self.ttl = ttl
+        self.persist = persist
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def claim(self, key):
+        """Returns `(entry, owner)`; `owner` is True when the caller must produce the result."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires_at > now:
+                self._entries.move_to_end(key)
+                return entry, False
+            entry = IdempotencyEntry(Future(), now + self.ttl)
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            excess = len(self._entries) - self.max_keys
+            if excess > 0:
+                # Dropping a key still in flight would let its retries render again.
+                completed = (old_key for old_key, old_entry in self._entries.items() if old_entry.future.done())
+                for old_key in list(itertools.islice(completed, excess)):
+                    del self._entries[old_key]
+            return entry, True
+
+    def abandon(self, key, entry, error):
+        """Fails the waiters of an owned entry and forgets it, so a later retry runs again."""
+        with self._lock:
+            if self._entries.get(key) is entry:
+                del self._entries[key]
+        entry.future.set_exception(error)
+
+    def _blob(self, key):
+        caller, idempotency_key = key
+        digest = hashlib.sha256(f"{caller or ''}\0{idempotency_key}".encode('utf-8')).hexdigest()
+        return bucket.blob(f"{IDEMPOTENCY_PREFIX}{digest}.json")
+
+    def load(self, key):
+        """Returns the persisted `(fingerprint, blob_path, cache_key)` of a key, or None."""
+        if not self.persist:
+            return None
+        try:
+            record = json.loads(self._blob(key).download_as_bytes())
+        except gcs_exceptions.NotFound:
+            return None
+        if record['created'] + self.ttl <= time.time():
+            return None
+        return record['fingerprint'], record['blob_path'], record['cache_key']
+
+    def save(self, key, fingerprint, blob_path, cache_key):
+        if not self.persist:
+            return
+        record = {'fingerprint': fingerprint, 'blob_path': blob_path, 'cache_key': cache_key, 'created': time.time()}
+        try:
+            self._blob(key).upload_from_string(json.dumps(record), content_type='application/json', if_generation_match=0)
+        except gcs_exceptions.PreconditionFailed:
+            app.logger.warning("Idempotency key was completed concurrently by another instance; keeping its record.")
+        except Exception as e:
+            app.logger.error(f"Could not persist idempotency key record: {e}", exc_info=True)
+
+
+idempotency_store = IdempotencyStore(IDEMPOTENCY_MAX_KEYS, IDEMPOTENCY_KEY_TTL, IDEMPOTENCY_STORE == 'gcs')
+
+
+def replay_contract(blob_path, cache_key):
+    """Returns the PDF bytes of an already published contract."""
+    cached = render_cache.get(cache_key)
+    if cached and cached[1] == blob_path:
+        return cached[0]
+    return bucket.blob(blob_path).download_as_bytes()
+
+
 @app.route('/generate-pdf', methods=['POST'])
 def generate_pdf():
     """
@@ -111,6 +1872,11 @@ def generate_pdf():
     produces:
       - application/pdf
     parameters:
+      - in: header
+        name: Idempotency-Key
+        type: string
+        required: false
+        description: "Çelës unik për kërkesën. Një përsëritje me të njëjtin çelës kthen të njëjtin PDF pa e gjeneruar ose ngarkuar përsëri. / Unique request key; a retry with the same key returns the same PDF without rendering or uploading it again."
       - in: body
         name: body
         required: true
@@ -146,15 +1912,25 @@ def generate_pdf():
     responses:
       200:
         description: "Suksess. PDF-ja u gjenerua dhe kthehet si përgjigje."
+      400:
+        description: "Kërkesë e Pavlefshme. Mungojnë fushat e kërkuara, ose 'customer_nipt' nuk mund të përdoret në emrin e dokumentit."
       401:
         description: "I Paautorizuar. Tokeni i autorizimit mungon, është i pavlefshëm, ose ka skaduar."
       404:
         description: "Nuk u Gjet. Një emër i template ose koordinatat e tij nuk u gjetën në server."
+      409:
+        description: "Konflikt. Dokumenti origjinal për këtë Idempotency-Key ende po publikohet; provoni përsëri pak më vonë."
+      422:
+        description: "E papërpunueshme. Idempotency-Key është përdorur tashmë me një kërkesë tjetër."
     """
 
     if not bucket:
         return jsonify({"error": "Server is not configured correctly. Cannot connect to storage."}), 500
 
+    idempotency_key = request.headers.get('Idempotency-Key')
+    if idempotency_key is not None and not 0 < len(idempotency_key) <= 255:
+        return jsonify({"error": "Idempotency-Key must be between 1 and 255 characters."}), 400
+
     try:
         data = request.get_json()
         template_names = data.get('template_names')
@@ -163,121 +1939,201 @@ def generate_pdf():
         if not template_names or not isinstance(template_names, list) or not context:
             return jsonify({"error": "Request must include 'template_names' (as a list) and 'context'."}), 400
 
-        if 'doc_date' in context:
+        error = find_invalid_nipt(context)
+        if error:
+            return jsonify({"error": error}), 400
+
+        prepare_context(context)
+
+        snapshot = template_snapshot
+        error = find_missing_template(snapshot, template_names)
+        if error:
+            return jsonify({"error": error}), 404
+
+        if not idempotency_key:
+            pdf_bytes, blob_path, _ = generate_contract(snapshot, template_names, context)
+            return send_file(io.BytesIO(pdf_bytes), mimetype='application/pdf', as_attachment=True,
+                             download_name=os.path.basename(blob_path))
+
+        key = (g.get('caller'), idempotency_key)
+        fingerprint = _canonical_digest({'template_names': template_names, 'context': context})
+        entry, owner = idempotency_store.claim(key)
+        if owner:
             try:
-                datetime.strptime(str(context['doc_date']), '%d-%m-%Y')
-            except (ValueError, TypeError):
-                app.logger.warning(f"Could not validate doc_date format: '{context.get('doc_date')}'. Using original value.")
-                pass
+                record = idempotency_store.load(key)
+                if record:
+                    owner = False
+                else:
+                    pdf_bytes, blob_path, cache_key = generate_contract(snapshot, template_names, context)
+                    record = (fingerprint, blob_path, cache_key)
+                    idempotency_store.save(key, *record)
+                entry.future.set_result(record)
+            except Exception as e:
+                idempotency_store.abandon(key, entry, e)
+                raise
 
-        if 'customer_address' in context and 'customer_city' in context:
-            context['customer_full_address'] = f'{context["customer_address"]}, {context["customer_city"]}'
-
-        stamped_pdf_parts = []
-
-        for template_name in template_names:
-            template_coords = COORDINATES.get(template_name)
-            if not template_coords:
-                return jsonify({"error": f"Coordinates for template '{template_name}' not found."}), 404
-
-            if template_name not in PDF_TEMPLATE_CACHE:
-                return jsonify({"error": f"Template PDF '{template_name}.pdf' not found in cache."}), 404
-
-            template_buffer = PDF_TEMPLATE_CACHE[template_name]
-            template_buffer.seek(0)
-
-            fields_by_page = {}
-            for field_name, coords in template_coords.get('static_fields', {}).items():
-                page_num = coords.get('page', 1) - 1
-                if page_num not in fields_by_page: fields_by_page[page_num] = []
-                if field_name in context:
-                    fields_by_page[page_num].append({
-                        "text": context[field_name], "x": coords['x'], "y": coords['y'],
-                        "align": coords.get('align', 'left')
-                    })
-
-            items_section_config = template_coords.get('items_section')
-            if items_section_config and context.get('items'):
-                page_num = items_section_config.get('page', 1) - 1
-                if page_num not in fields_by_page: fields_by_page[page_num] = []
-                fields_by_page[page_num].extend([
-                    {"type": "items_list", "config": items_section_config, "data": context.get('items', [])},
-                    {"type": "final_total", "config": items_section_config, "value": context.get('total')}
-                ])
-
-            reader = PdfReader(template_buffer)
-            writer = PdfWriter()
-
-            for i, page in enumerate(reader.pages):
-                if i in fields_by_page:
-                    packet = io.BytesIO()
-                    can = canvas.Canvas(packet, pagesize=letter)
-                    last_item_y = 0
-                    for field in fields_by_page[i]:
-                        if field.get("type") == "items_list":
-                            config, current_y = field['config'], field['config']['start_y']
-                            for item in field['data']:
-                                can.drawString(config['columns']['name_x'], current_y, str(item.get('name', '')))
-                                can.drawString(config['columns']['qty_x'], current_y, str(item.get('qty', '')))
-                                can.drawString(config['columns']['price_x'], current_y, str(item.get('price', '')))
-                                can.drawString(config['columns']['total_x'], current_y, str(item.get('total', '')))
-                                last_item_y = current_y
-                                current_y -= config['line_height']
-                        elif field.get("type") == "final_total":
-                            if field.get('value') and last_item_y > 0:
-                                config = field['config']
-                                total_y = last_item_y - (2 * config['line_height'])
-                                total_x = config['columns']['name_x']
-                                can.drawString(total_x, total_y, f"Total: {field['value']}")
-                        else:
-                            text = str(field['text'])
-                            if field.get("align") == "center":
-                                text_width = can.stringWidth(text)
-                                x_pos = field['x'] - (text_width / 2)
-                                can.drawString(x_pos, field['y'], text)
-                            else:
-                                can.drawString(field['x'], field['y'], text)
-                    can.save()
-                    packet.seek(0)
-                    stamp_pdf = PdfReader(packet)
-                    if stamp_pdf.pages:
-                        page.merge_page(stamp_pdf.pages[0])
-                writer.add_page(page)
-
-            part_buffer = io.BytesIO()
-            writer.write(part_buffer)
-            stamped_pdf_parts.append(part_buffer)
-
-        final_writer = PdfWriter()
-        for part_buffer in stamped_pdf_parts:
-            part_buffer.seek(0)
-            reader = PdfReader(part_buffer)
-            for page in reader.pages:
-                final_writer.add_page(page)
-
-        final_buffer = io.BytesIO()
-        final_writer.write(final_buffer)
-        final_buffer.seek(0)
-
-        nipt = context.get('customer_nipt', 'unknown')
-        timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-        file_name = f"{nipt}_{timestamp}.pdf"
-
-        blob_path = f"contracts/{file_name}"
-        blob = bucket.blob(blob_path)
-
-        blob.upload_from_file(final_buffer, content_type='application/pdf')
-        app.logger.info(f"Successfully uploaded '{file_name}' to GCS.")
-
-        final_buffer.seek(0)
-        return send_file(final_buffer, mimetype='application/pdf', as_attachment=True,
-                         download_name=file_name)
+        original_fingerprint, blob_path, cache_key = entry.future.result()
+        if original_fingerprint != fingerprint:
+            return jsonify({"error": "Idempotency-Key was already used with a different request."}), 422
+
+        if not owner:
+            app.logger.info(f"Replaying '{blob_path}' for a repeated Idempotency-Key.")
+            try:
+                pdf_bytes = replay_contract(blob_path, cache_key)
+            except gcs_exceptions.NotFound:
+                return jsonify({"error": "The original document is still being published. Please retry shortly."}), 409
+
+        response = send_file(io.BytesIO(pdf_bytes), mimetype='application/pdf', as_attachment=True,
+                             download_name=os.path.basename(blob_path))
+        if not owner:
+            response.headers['Idempotent-Replayed'] = 'true'
+        return response
 
     except Exception as e:
         app.logger.error(f"An unexpected error occurred: {e}", exc_info=True)
         return jsonify({"error": "An unexpected server error occurred."}), 500
 
 
+@app.route('/generate-pdf/batch', methods=['POST'])
+def generate_pdf_batch():
+    """
+    Gjeneron shumë Fatura ose Kontrata në një thirrje / Generate many PDF Invoices or Contracts in one call
+    This endpoint stamps every context in `contexts` onto the same templates, uploads
+    each resulting document to Google Cloud Storage and returns one result per context,
+    in request order. A failing context does not stop the rest of the batch.
+    ---
+    tags:
+      - "Gjenerimi i PDF (PDF Generation)"
+    security:
+      - BearerAuth: []
+    consumes:
+      - application/json
+    produces:
+      - application/json
+    parameters:
+      - in: body
+        name: body
+        required: true
+        description: "Lista e kontekstit për çdo dokument dhe template-t e përbashkëta."
+        schema:
+          id: PdfBatchGenerationRequest
+          required:
+            - template_names
+            - contexts
+          properties:
+            template_names:
+              type: array
+              example: ["kontrate_template", "oferte_template"]
+            contexts:
+              type: array
+              items:
+                type: object
+              example:
+                - customer_name: "Alb-Tech Servis Sh.p.k."
+                  customer_nipt: "L12345678P"
+                  doc_date: "25-09-2025"
+                - customer_name: "Quantum Solutions Ltd."
+                  customer_nipt: "L12345678A"
+                  doc_date: "25-09-2025"
+    responses:
+      200:
+        description: "Suksess. Kthehet një rezultat (`gcs_path` ose `error`) për çdo kontekst."
+      400:
+        description: "Kërkesë e Pavlefshme. `template_names` ose `contexts` mungojnë, ose ka shumë kontekste."
+      401:
+        description: "I Paautorizuar. Tokeni i autorizimit mungon, është i pavlefshëm, ose ka skaduar."
+      404:
+        description: "Nuk u Gjet. Një emër i template ose koordinatat e tij nuk u gjetën në server."
+    """
+
+    if not bucket:
+        return jsonify({"error": "Server is not configured correctly. Cannot connect to storage."}), 500
+
+    try:
+        data = request.get_json()
+        template_names = data.get('template_names')
+        contexts = data.get('contexts')
+
+        if not template_names or not isinstance(template_names, list) or not contexts or not isinstance(contexts, list):
+            return jsonify({"error": "Request must include 'template_names' and 'contexts' (both as lists)."}), 400
+
+        if len(contexts) > BATCH_MAX_ITEMS:
+            return jsonify({"error": f"A batch may contain at most {BATCH_MAX_ITEMS} contexts."}), 400
+
+        snapshot = template_snapshot
+        error = find_missing_template(snapshot, template_names)
+        if error:
+            return jsonify({"error": error}), 404
+
+        results = [None] * len(contexts)
+        pending_renders = deque()
+        pending_uploads = {}
+
+        def collect_upload(future):
+            index, cache_key, pdf_bytes = pending_uploads.pop(future)
+            try:
+                blob_path = future.result()
+                render_cache.put(cache_key, pdf_bytes, blob_path)
+                results[index] = {"index": index, "gcs_path": f"gs://{BUCKET_NAME}/{blob_path}"}
+            except Exception as e:
+                app.logger.error(f"Batch item {index}: upload failed: {e}", exc_info=True)
+                results[index] = {"index": index, "error": "Upload to storage failed."}
+
+        def collect_render():
+            index, context, cache_key, future = pending_renders.popleft()
+            try:
+                pdf_bytes = future.result()
+            except Exception as e:
+                app.logger.error(f"Batch item {index}: rendering failed: {e}", exc_info=True)
+                results[index] = {"index": index, "error": "Rendering failed."}
+                return
+
+            if len(pending_uploads) >= 2 * BATCH_UPLOAD_CONCURRENCY:
+                done, _ = wait(pending_uploads, return_when=FIRST_COMPLETED)
+                for done_future in done:
+                    collect_upload(done_future)
+
+            pending_uploads[uploader.submit(upload_contract, context, pdf_bytes)] = (index, cache_key, pdf_bytes)
+
+        # Rendering is CPU-bound, uploads are I/O-bound: uploads run in the
+        # background while the next contexts render, with bounded backlogs. With
+        # the process backend several contexts also render in parallel.
+        render_window = RENDER_PROCESSES if RENDER_BACKEND == 'process' else 1
+        with ThreadPoolExecutor(max_workers=BATCH_UPLOAD_CONCURRENCY) as uploader:
+            for index, context in enumerate(contexts):
+                if not context or not isinstance(context, dict):
+                    results[index] = {"index": index, "error": "Each context must be a non-empty object."}
+                    continue
+                error = find_invalid_nipt(context)
+                if error:
+                    results[index] = {"index": index, "error": error}
+                    continue
+
+                prepare_context(context)
+                cache_key = render_cache_key(snapshot, template_names, context)
+                cached = render_cache.get(cache_key)
+                if cached:
+                    results[index] = {"index": index, "gcs_path": f"gs://{BUCKET_NAME}/{cached[1]}"}
+                    continue
+
+                pending_renders.append((index, context, cache_key, submit_render(snapshot, template_names, context)))
+                if len(pending_renders) >= render_window:
+                    collect_render()
+
+            while pending_renders:
+                collect_render()
+            for future in list(pending_uploads):
+                collect_upload(future)
+
+        failed = sum(1 for result in results if 'error' in result)
+        app.logger.info(f"Batch of {len(contexts)} contexts finished: {len(contexts) - failed} generated, {failed} failed.")
+        return jsonify({"results": results}), 200
+
+    except Exception as e:
+        app.logger.error(f"An unexpected error occurred during batch generation: {e}", exc_info=True)
+        return jsonify({"error": "An unexpected server error occurred."}), 500
+
+
 @app.route('/get-contracts/<string:nipt>', methods=['GET'])
 def get_contracts_by_nipt(nipt):
     """
@@ -322,25 +2178,13 @@ def get_contracts_by_nipt(nipt):
             app.logger.info(f"No contracts found for NIPT: {nipt}")
             return jsonify({"error": f"No contract PDFs found for NIPT '{nipt}'"}), 404
 
-        zip_buffer = io.BytesIO()
+        app.logger.info(f"Found {len(blobs)} contracts for NIPT {nipt}. Streaming ZIP archive.")
 
-        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zf:
-            app.logger.info(f"Found {len(blobs)} contracts for NIPT {nipt}. Creating ZIP archive.")
-            for blob in blobs:
-                pdf_content = blob.download_as_bytes()
-                file_name = os.path.basename(blob.name)
-                zf.writestr(file_name, pdf_content)
-
-        zip_buffer.seek(0)
-        
         zip_download_name = f"{nipt}_contracts.zip"
 
-        return send_file(
-            zip_buffer,
-            mimetype='application/zip',
-            as_attachment=True,
-            download_name=zip_download_name
-        )
+        response = Response(stream_contracts_zip(nipt, blobs), mimetype='application/zip')
+        response.headers.set('Content-Disposition', 'attachment', **attachment_filename_options(zip_download_name))
+        return response
 
     except Exception as e:
         app.logger.error(f"An unexpected error occurred while fetching contracts for NIPT {nipt}: {e}", exc_info=True)
@@ -385,18 +2229,27 @@ def get_latest_contract_by_nipt(nipt):
         return jsonify({"error": "Server is not configured correctly. Cannot connect to storage."}), 500
 
     try:
-        prefix = f"contracts/{nipt}_"
-        blobs = list(storage_client.list_blobs(BUCKET_NAME, prefix=prefix))
+        latest = load_latest_contract(nipt)
 
-        if not blobs:
+        if not latest:
             app.logger.info(f"No contract found for NIPT: {nipt}")
             return jsonify({"error": f"No contract PDF found for NIPT '{nipt}'"}), 404
 
+        latest_blob = bucket.blob(latest)
+        try:
+            pdf_content = latest_blob.download_as_bytes()
+        except gcs_exceptions.NotFound:
+            app.logger.warning(f"Latest contract pointer for NIPT {nipt} points to missing '{latest_blob.name}', rebuilding it.")
+            drop_latest_contract(nipt)
+            latest = rebuild_latest_contract(nipt)
+            if not latest:
+                return jsonify({"error": f"No contract PDF found for NIPT '{nipt}'"}), 404
+            latest_blob = bucket.blob(latest)
+            pdf_content = latest_blob.download_as_bytes()
 
-        latest_blob = blobs[-1]
         app.logger.info(f"Found latest contract for NIPT {nipt}: {latest_blob.name}")
 
-        pdf_buffer = io.BytesIO(latest_blob.download_as_bytes())
+        pdf_buffer = io.BytesIO(pdf_content)
         pdf_buffer.seek(0)
 
         return send_file(
@@ -411,6 +2264,50 @@ def get_latest_contract_by_nipt(nipt):
         return jsonify({"error": "An unexpected server error occurred."}), 500
 
 
+def start_background_threads():
+    global template_refresher, upload_spool, render_pool_builder
+    if bucket and TEMPLATE_REFRESH_INTERVAL > 0:
+        template_refresher = TemplateRefresher(TEMPLATE_REFRESH_INTERVAL)
+        template_refresher.start()
+        atexit.register(template_refresher.stop)
+
+    if bucket and UPLOAD_MODE == 'spool':
+        upload_spool = UploadSpool(UPLOAD_SPOOL_DIR)
+        upload_spool.start()
+        atexit.register(upload_spool.stop)
+
+    if RENDER_BACKEND == 'process':
+        render_pool_builder = RenderPoolBuilder()
+        render_pool_builder.start()
+        atexit.register(render_pool_builder.stop)
+
+
+def reinitialize_after_fork():
+    """
+    Called in each gunicorn worker right after it is forked from a master that
+    preloaded this module (see gunicorn.conf.py). The parsed templates, render
+    plans and caches are kept as inherited, shared copy-on-write with the
+    master and the other workers. What must not be shared is rebuilt: the GCS
+    client and the token verifier's HTTP session (their pooled connections
+    would otherwise be used by several processes at once) and the background
+    threads, which do not survive a fork. The master never starts a render
+    pool; each worker's own pool builder starts one for it.
+    """
+    global storage_client, bucket, token_verifier
+    if bucket is not None:
+        storage_client = storage.Client()
+        bucket = storage_client.bucket(BUCKET_NAME)
+    token_verifier = GoogleIdTokenVerifier()
+    start_background_threads()
+    app.logger.info(f"Worker {os.getpid()} re-initialized after fork.")
+
+
+# With PRELOAD_APP the master only loads templates; every worker starts its
+# own background threads in reinitialize_after_fork.
+if not PRELOAD_APP and not IS_RENDER_WORKER:
+    start_background_threads()
+
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 8080))
     app.run(host='0.0.0.0', port=port, debug=True)
\ No newline at end of file
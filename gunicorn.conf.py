@@ -0,0 +1,25 @@
+import gc
+import os
+
+bind = f":{os.environ.get('PORT', 8080)}"
+workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+timeout = 0
+
+# With PRELOAD_APP=true the master imports app.py once, downloading and parsing
+# the templates a single time; workers inherit them copy-on-write instead of
+# each repeating the GCS setup and downloads.
+preload_app = os.environ.get('PRELOAD_APP', 'false').lower() == 'true'
+
+
+def pre_fork(server, worker):
+    # Move everything loaded so far out of the garbage collector's reach, so
+    # collections in the workers do not touch (and thereby copy) shared pages.
+    if preload_app:
+        gc.freeze()
+
+
+def post_fork(server, worker):
+    if preload_app:
+        import app
+        app.reinitialize_after_fork()